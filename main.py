@@ -1,60 +1,137 @@
+import functools
 import logging
+import multiprocessing
 import os
+import re
 import time
+from collections import Counter
 from datetime import datetime
-from typing import Optional
-from utils.client_backup import backup_database, DATABASES
+from typing import Dict, Optional, Set
+from concurrent.futures import BrokenExecutor, Executor, ProcessPoolExecutor, wait
+from utils.client_backup import backup_database, DATABASES, SAFE_DATABASES
 from utils.logging_config import init_logging
+from utils.state import load_state, state_key
 
-""" Commands CLi:
+""" Requiere zstd instalado en el host (compresión de los respaldos y restauración de los .zst).
+ Commands CLi:
      python3 -m utils.client_restore list --type postgres --db squidstasts --container my_postgres 
       python3 -m utils.client_restore restore --type postgres --db squidstasts --container my_postgres
       python3 -m utils.client_restore restore --type postgres --file ./backups/postgres/squidstasts_20250807_230117.backup --container my_postgres
       python3 -m utils.client_restore list --type mysql --db midb --container my_mysql python3 -m utils.client_restore restore --type mysql --db midb --container my_mysql
  """
 
-def _has_today_backup(backup_dir: str, db_name: Optional[str], *, extensions=(".sql", ".backup")) -> bool:
+def _today_pattern(date_tag: str) -> "re.Pattern[str]":
+    # <db>_<YYYYMMDD>[_HHMMSS].<sql|backup>[.zst] o .tar.zst; el grupo captura el nombre de la base.
+    # Con fullmatch los .<nombre>.partial de un respaldo en curso nunca cuentan como hechos
+    return re.compile(rf"(?P<db>.+)_{date_tag}(?:_\d+)?\.(?:(?:sql|backup)(?:\.zst)?|tar\.zst)")
+
+
+def _databases_backed_up_today(backup_dir: str, pattern: "re.Pattern[str]") -> Set[str]:
+    # un único recorrido del directorio por ciclo, compartido por todas las configs que lo usan
+    done: Set[str] = set()
     if not os.path.isdir(backup_dir):
-        return False
-    date_tag = datetime.now().strftime("%Y%m%d")
-    for f in os.listdir(backup_dir):
-        if db_name:
-            if not f.startswith(f"{db_name}_{date_tag}"):
-                continue
-        else:
-            # buscar patrón _YYYYMMDD_ en el nombre
-            if f"_{date_tag}_" not in f:
-                continue
-        if any(f.endswith(ext) for ext in extensions):
-            return True
-    return False
+        return done
+    with os.scandir(backup_dir) as it:
+        for entry in it:
+            m = pattern.fullmatch(entry.name)
+            if m:
+                done.add(m.group('db'))
+    return done
 
 
-def run_once():
-    for db_conf in DATABASES:
+def run_once(pool: Optional[Executor] = None, today_tag: Optional[str] = None):
+    state = load_state()
+    if today_tag is None:
+        today_tag = datetime.now().strftime("%Y%m%d")
+    pattern = _today_pattern(today_tag)
+    scanned: Dict[str, Set[str]] = {}
+    # los nombres de archivo solo llevan <db>_<fecha>: el escaneo no distingue de qué servidor o
+    # usuario vino un respaldo, así que solo se usa si la config es la única que escribe en ese directorio
+    dir_users = Counter(os.path.abspath(c.get('backup_dir', './')) for c in DATABASES)
+    futs = {}
+    for db_conf, safe_conf in zip(DATABASES, SAFE_DATABASES):
         db_type = db_conf.get('type', 'postgres').lower()
         backup_dir = db_conf.get('backup_dir', './')
         named_db = db_conf.get('db')
-        if _has_today_backup(backup_dir, named_db):
+        key = state_key(db_conf)
+        already_done: Set[str] = set()
+        # el estado evita escanear el directorio; sin registro se cae al escaneo
+        if key in state:
+            done = state[key] == today_tag
+        elif dir_users[os.path.abspath(backup_dir)] > 1:
+            done = False
+        else:
+            if backup_dir not in scanned:
+                scanned[backup_dir] = _databases_backed_up_today(backup_dir, pattern)
+            done_today = scanned[backup_dir]
+            if named_db:
+                done = named_db in done_today
+            else:
+                # config múltiple (quizá a medias): backup_database solo respalda las bases que faltan
+                done, already_done = False, done_today
+        if done:
             if named_db:
                 logging.info("Ya existe respaldo de hoy para %s (%s)", named_db, db_type)
             else:
                 logging.info("Ya existe respaldo de hoy (config múltiple %s) en %s", db_type, backup_dir)
             continue
-        logging.info("Respaldando base(s) (%s): %s", db_type, {k: ('***' if k == 'password' else v) for k, v in db_conf.items()})
-        backup_database(db_conf)
+        logging.info("Respaldando base(s) (%s): %s", db_type, safe_conf)
+        if pool is None:
+            backup_database(db_conf, already_done)
+        else:
+            futs[pool.submit(backup_database, db_conf, already_done)] = safe_conf
+    for fut in wait(futs).done:
+        exc = fut.exception()
+        if isinstance(exc, BrokenExecutor):
+            raise exc
+        if exc is not None:
+            logging.error("Error respaldando %s", futs[fut], exc_info=exc)
+
+
+def _new_pool(log_path: str) -> ProcessPoolExecutor:
+    # spawn explícito: no depende del método por defecto del intérprete ni hace fork con el hilo
+    # del QueueListener vivo; cada worker configura su propio logging hacia el mismo archivo
+    if log_path:
+        initializer = functools.partial(init_logging, log_dir=os.path.dirname(log_path) or '.',
+                                        filename=os.path.basename(log_path))
+    else:
+        initializer = init_logging
+    return ProcessPoolExecutor(
+        max_workers=len(DATABASES) or 1,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=initializer,
+    )
 
 
 def daemon(interval_seconds: int = 600):
-    init_logging()
+    log_path = init_logging()
     logging.info("Iniciando daemon de respaldo (intervalo=%ss)", interval_seconds)
-    while True:
-        try:
-            run_once()
-            logging.info("Verificación completada. Próxima en %s segundos", interval_seconds)
-        except Exception:
-            logging.exception("Error durante ciclo de respaldo")
-        time.sleep(interval_seconds)
+    # pool persistente: los workers quedan calientes entre ciclos
+    pool = _new_pool(log_path)
+    # reloj monotónico: el periodo no deriva con la duración de cada ciclo
+    next_tick = time.monotonic()
+    try:
+        while True:
+            try:
+                run_once(pool, datetime.now().strftime("%Y%m%d"))
+                logging.info("Verificación completada. Próxima en %s segundos", interval_seconds)
+            except BrokenExecutor:
+                logging.exception("Pool de respaldo roto; se recrea")
+                pool.shutdown(wait=False, cancel_futures=True)
+                pool = _new_pool(log_path)
+            except Exception:
+                logging.exception("Error durante ciclo de respaldo")
+            next_tick += interval_seconds
+            now = time.monotonic()
+            if now > next_tick:
+                missed = int((now - next_tick) // interval_seconds) + 1
+                logging.warning("El ciclo excedió el intervalo (%s ciclo(s) perdido(s))", missed)
+                if missed > 1:
+                    # no intentar recuperar en ráfaga los ciclos perdidos
+                    next_tick = now + interval_seconds
+            time.sleep(max(0.0, next_tick - time.monotonic()))
+    finally:
+        pool.shutdown(cancel_futures=True)
 
 
 def main():
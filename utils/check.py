@@ -1,19 +1,95 @@
+import errno
 import hashlib
+import os
+import shutil
+import tempfile
 
-def file_sha256sum(filepath, chunk_size=8192):
-    sha256 = hashlib.sha256()
+try:  # opcional: pip install blake3
+    import blake3
+except ImportError:
+    blake3 = None
+
+CHUNK_SIZE = 1 << 20  # 1 MiB
+DEFAULT_ALGO = 'blake3' if blake3 is not None else 'sha256'
+
+def file_sha256sum(filepath, chunk_size=CHUNK_SIZE):
     with open(filepath, 'rb') as f:
-        for chunk in iter(lambda: f.read(chunk_size), b''):
-            sha256.update(chunk)
+        if hasattr(hashlib, 'file_digest'):  # Python 3.11+
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+        sha256 = hashlib.sha256()
+        buf = memoryview(bytearray(chunk_size))
+        n = f.readinto(buf)
+        while n:
+            sha256.update(buf[:n])
+            n = f.readinto(buf)
     return sha256.hexdigest()
 
+def file_blake3(filepath):
+    if blake3 is None:
+        raise RuntimeError("blake3 no está instalado")
+    # mmap + hashing multihilo (SIMD) dentro de la extensión
+    hasher = blake3.blake3(max_threads=blake3.blake3.AUTO)
+    hasher.update_mmap(filepath)
+    return hasher.hexdigest()
+
+def new_hasher(algo=None):
+    # hasher incremental (update/hexdigest) para calcular el hash mientras se escribe el archivo
+    algo = algo or DEFAULT_ALGO
+    if algo == 'blake3':
+        if blake3 is None:
+            raise RuntimeError("blake3 no está instalado")
+        return algo, blake3.blake3()
+    if algo == 'sha256':
+        return algo, hashlib.sha256()
+    raise ValueError(f"Algoritmo de hash no soportado: {algo}")
+
+def write_checksum(filepath, algo, digest):
+    # <archivo>.<algo> en formato "digest  nombre", compatible con sha256sum -c / b3sum -c.
+    # Temporal + os.replace: nunca queda un sidecar truncado junto al respaldo
+    directory, name = os.path.split(filepath)
+    fd, tmp = tempfile.mkstemp(dir=directory or '.', prefix=f".{name}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(f"{digest}  {name}\n")
+        os.replace(tmp, f"{filepath}.{algo}")
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+def file_hash(filepath, algo=None):
+    # devuelve (algo, digest): BLAKE3 por defecto, SHA-256 si blake3 no está disponible
+    algo = algo or DEFAULT_ALGO
+    if algo == 'blake3':
+        return algo, file_blake3(filepath)
+    if algo == 'sha256':
+        return algo, file_sha256sum(filepath)
+    raise ValueError(f"Algoritmo de hash no soportado: {algo}")
+
 def verify_file_integrity(filepath, expected_hash):
-    return file_sha256sum(filepath) == expected_hash
+    # expected_hash: (algo, digest) o un digest SHA-256 suelto (formato anterior)
+    if isinstance(expected_hash, str):
+        algo, digest = 'sha256', expected_hash
+    else:
+        algo, digest = expected_hash
+    return file_hash(filepath, algo)[1] == digest
 
 def copy_file(src, dst):
-    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
-        while True:
-            chunk = fsrc.read(8192)
-            if not chunk:
-                break
-            fdst.write(chunk)
+    # copy_file_range copia dentro del kernel (reflink en btrfs/XFS); si no está
+    # disponible, shutil.copyfile usa sendfile en Linux
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if n == 0:
+                        break
+                    remaining -= n
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM):
+                raise
+    shutil.copyfile(src, dst)
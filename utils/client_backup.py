@@ -2,49 +2,158 @@ from __future__ import annotations
 
 import os
 import json
-import shlex
 import logging
+import shutil
+import signal
 import subprocess
+import tempfile
+import functools
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import IO, Any, Dict, Iterable, Iterator, List, Optional
+
+from .check import CHUNK_SIZE, new_hasher, write_checksum
+from .docker_shell import close_all as close_shells, docker_shell
+from .logging_config import LazyCmd
+from .state import load_state, mark_done, state_key
 
 CONFIG_FILE = os.path.join(os.path.dirname(__file__), '../databases.json')
 POSTGRES_EXCLUDE = {"postgres"}
 MYSQL_EXCLUDE = {"information_schema", "performance_schema", "mysql", "sys"}
+MYSQL_PWD_PASSTHROUGH = {"MYSQL_PWD": None}
+ZSTD_EXT = ".zst"
+# zstd corre en el host (no en el contenedor): es una dependencia obligatoria para respaldar
+# y para restaurar los archivos .zst
+ZSTD_COMPRESS = ["zstd", "-T0", "-3", "-q", "-c"]
+ZSTD_MISSING = "zstd no está instalado en el host (se necesita para los archivos .zst): instale el paquete zstd"
+PG_ARCHIVE_EXT = ".tar" + ZSTD_EXT
+PG_DUMP_JOBS = 4
+PARTIAL_EXT = ".partial"
+
+try:  # opcional: pip install orjson
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    def _loads(raw: bytes) -> Any:
+        return json.loads(raw.decode('utf-8'))
+
+@functools.lru_cache(maxsize=4)
+def _load_config_cached(path: str, mtime: float) -> List[Dict[str, Any]]:
+    # mtime forma parte de la clave: si el archivo cambia se vuelve a parsear
+    with open(path, 'rb') as f:
+        data = _loads(f.read())
+    return data.get('databases', []) or []
 
 def load_config(path: str = CONFIG_FILE) -> List[Dict[str, Any]]:
     try:
-        with open(path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            return data.get('databases', []) or []
+        return list(_load_config_cached(path, os.path.getmtime(path)))
     except (FileNotFoundError, json.JSONDecodeError) as e:
         logging.error("Config error (%s): %s", path, e)
         return []
 
+def sanitize_conf(db_conf: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: ('***' if k == 'password' else v) for k, v in db_conf.items()}
+
 DATABASES: List[Dict[str, Any]] = load_config()
+SAFE_DATABASES: List[Dict[str, Any]] = [sanitize_conf(c) for c in DATABASES]
 
 def ensure_backup_dir(backup_dir: str) -> None:
     os.makedirs(backup_dir, exist_ok=True)
 
-def run(cmd: List[str], *, env: Optional[Dict[str, str]] = None, capture: bool = False) -> subprocess.CompletedProcess:
-    logging.debug("RUN: %s", ' '.join(shlex.quote(c) for c in cmd))
+@contextlib.contextmanager
+def atomic_output(path: str) -> Iterator[IO[bytes]]:
+    # Se escribe en .<nombre>.partial y solo al terminar bien se renombra con os.replace
+    # (atómico en el mismo filesystem): quien escanee el directorio nunca ve un dump a medias
+    tmp = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}{PARTIAL_EXT}")
+    try:
+        with open(tmp, 'wb') as f:
+            yield f
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp)
+        raise
+
+def run(cmd: List[str], *, env: Optional[Dict[str, str]] = None, capture: bool = False, stdout: Optional[IO[bytes]] = None,
+        stdin: Optional[IO[bytes]] = None) -> subprocess.CompletedProcess:
+    logging.debug("RUN: %s", LazyCmd(cmd))
+    if stdout is not None or stdin is not None:
+        return subprocess.run(cmd, check=True, stdin=stdin, stdout=stdout, stderr=subprocess.PIPE, env=env)
     return subprocess.run(cmd, check=True, text=capture, capture_output=capture, env=env)
 
-def docker_exec(container: str, inner_cmd: List[str], env_vars: Optional[Dict[str, str]] = None, capture: bool = False) -> subprocess.CompletedProcess:
+def run_pipeline(cmds: List[List[str]], *, env: Optional[Dict[str, str]] = None, stdout: Optional[IO[bytes]] = None,
+                 hasher: Any = None) -> None:
+    # Equivalente a "cmd1 | cmd2 | ..." sin shell; CalledProcessError de la etapa que realmente falló.
+    # Con hasher, la salida de la última etapa pasa por Python: se escribe en stdout y se hashea en la misma pasada
+    logging.debug("RUN: %s", LazyCmd(*cmds))
+    procs: List[subprocess.Popen] = []
+    errs: List[IO[bytes]] = []
+    try:
+        prev = None
+        for i, cmd in enumerate(cmds):
+            # stderr a archivo temporal: un PIPE sin leer puede bloquear la etapa y con ella toda la tubería
+            err = tempfile.TemporaryFile()
+            errs.append(err)
+            last = i == len(cmds) - 1
+            out = stdout if last and hasher is None else subprocess.PIPE
+            proc = subprocess.Popen(cmd, stdin=prev, stdout=out, stderr=err, env=env)
+            if prev is not None:
+                prev.close()  # el siguiente proceso es el único lector
+            prev = proc.stdout
+            procs.append(proc)
+        if hasher is not None:
+            with prev:
+                for chunk in iter(functools.partial(prev.read, CHUNK_SIZE), b''):
+                    if stdout is not None:
+                        stdout.write(chunk)
+                    hasher.update(chunk)
+        for proc in procs:
+            proc.wait()
+        failed = [(proc, err) for proc, err in zip(procs, errs) if proc.returncode]
+        if failed:
+            # Una etapa que muere por SIGPIPE solo refleja que la siguiente dejó de leer:
+            # se informa la última etapa que falló por sí misma, con su stderr
+            real = [(proc, err) for proc, err in failed if proc.returncode != -signal.SIGPIPE]
+            proc, err = (real or failed)[-1]
+            err.seek(0)
+            raise subprocess.CalledProcessError(proc.returncode, proc.args, stderr=err.read())
+    finally:
+        for proc in procs:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        for err in errs:
+            err.close()
+
+def docker_exec_cmd(container: str, inner_cmd: List[str], env_vars: Optional[Dict[str, Optional[str]]] = None, *, interactive: bool = False) -> List[str]:
     cmd = ["docker", "exec"]
+    if interactive:
+        cmd.append("-i")
     if env_vars:
         for k, v in env_vars.items():
-            cmd += ["-e", f"{k}={v}"]
+            # valor None: "-e KEY", docker lo toma del entorno del cliente y no queda en la línea de comandos
+            cmd += ["-e", k if v is None else f"{k}={v}"]
     cmd.append(container)
     cmd += inner_cmd
-    return run(cmd, capture=capture)
+    return cmd
+
+def shell_exec(container: str, inner_cmd: List[str], env_vars: Optional[Dict[str, str]] = None) -> subprocess.CompletedProcess:
+    # comandos con salida de texto (de cualquier duración): se reutiliza una sesión "docker exec -i sh"
+    # del contenedor en lugar de abrir un docker exec nuevo
+    with docker_shell(container) as sh:
+        return sh.run(inner_cmd, env_vars)
+
+def mysql_env(password: str) -> Dict[str, str]:
+    # la contraseña viaja en MYSQL_PWD, nunca como -p<password> en argv (/proc/<pid>/cmdline)
+    return {**os.environ, "MYSQL_PWD": password}
 
 def list_postgres_databases(user: str, password: str, port: str, host: str, *, container: Optional[str]) -> List[str]:
     query = "SELECT datname FROM pg_database WHERE datistemplate = false;"
     if container:
         # Versión simplificada para contenedores - sin host/port
         base_cmd = ["psql", "-U", user, "-d", "postgres", "-t", "-c", query]
-        result = docker_exec(container, base_cmd, capture=True)
+        result = shell_exec(container, base_cmd)
     else:
         # Versión original con contraseña para conexiones externas
         base_cmd = ["psql", "-U", user, "-h", host, "-p", port, "-d", "postgres", "-t", "-c", query]
@@ -55,16 +164,17 @@ def list_mysql_databases(user: str, password: str, port: str, host: str, *, cont
     query = "SHOW DATABASES;"
     if container:
         # Versión simplificada para contenedores - sin host/port
-        base_parts = ["mysql", f"-u{user}", f"-p{password}", "-e", query]
+        base_parts = ["mysql", f"-u{user}", "-e", query]
     else:
-        base_parts = ["mysql", f"-u{user}", f"-p{password}", f"-P{port}", "-e", query]
+        base_parts = ["mysql", f"-u{user}", f"-P{port}", "-e", query]
         if host:
-            base_parts.insert(3, f"-h{host}")  # after user/pass
+            base_parts.insert(2, f"-h{host}")  # after user
+    env = mysql_env(password)
 
     def attempt(parts: List[str]) -> subprocess.CompletedProcess:
         if container:
-            return docker_exec(container, parts, capture=True)
-        return run(parts, capture=True)
+            return shell_exec(container, parts, {"MYSQL_PWD": password})
+        return run(parts, capture=True, env=env)
 
     try:
         result = attempt(base_parts)
@@ -78,47 +188,77 @@ def list_mysql_databases(user: str, password: str, port: str, host: str, *, cont
             raise
     return [d.strip() for d in result.stdout.splitlines() if d.strip() and d.strip() not in MYSQL_EXCLUDE and not d.startswith("Database")]
 
-def backup_postgres_db(db: str, user: str, password: str, port: str, host: str, backup_dir: str, container: Optional[str]) -> None:
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    r_plain = f"/tmp/{db}_{ts}.sql"
-    r_custom = f"/tmp/{db}_{ts}.backup"
-    l_plain = os.path.join(backup_dir, f"{db}_{ts}.sql")
-    l_custom = os.path.join(backup_dir, f"{db}_{ts}.backup")
+def backup_postgres_db(db: str, user: str, password: str, port: str, host: str, backup_dir: str, container: Optional[str], ts: str,
+                       *, jobs: int = PG_DUMP_JOBS) -> None:
+    # Un único dump en formato directorio (-Fd) con -j tablas en paralelo, empaquetado con tar | zstd.
+    # pg_restore puede convertirlo luego a plain/custom si hiciera falta.
+    l_archive = os.path.join(backup_dir, f"{db}_{ts}{PG_ARCHIVE_EXT}")
+    algo, hasher = new_hasher()
     if container:
         # Versión simplificada para contenedores - sin host/port
-        docker_exec(container, ["pg_dump", "-U", user, "-d", db, "-F", "p", "-f", r_plain])
-        run(["docker", "cp", f"{container}:{r_plain}", l_plain])
-        docker_exec(container, ["rm", r_plain])
-        docker_exec(container, ["pg_dump", "-U", user, "-d", db, "-F", "c", "-f", r_custom])
-        run(["docker", "cp", f"{container}:{r_custom}", l_custom])
-        docker_exec(container, ["rm", r_custom])
+        r_dir = f"/tmp/{db}_{ts}.dir"
+        with docker_shell(container) as sh:
+            try:
+                sh.run(["pg_dump", "-U", user, "-d", db, "-F", "d", "-j", str(jobs), "-Z", "0", "-f", r_dir])
+                # el tar es binario: va por su propio docker exec directo al archivo
+                with atomic_output(l_archive) as f:
+                    run_pipeline([docker_exec_cmd(container, ["tar", "-C", r_dir, "-cf", "-", "."]), ZSTD_COMPRESS], stdout=f, hasher=hasher)
+                    # el sidecar se escribe antes de renombrar el dump: un respaldo visible siempre tiene su hash
+                    write_checksum(l_archive, algo, hasher.hexdigest())
+            finally:
+                try:
+                    sh.run(["rm", "-rf", r_dir])
+                except subprocess.CalledProcessError:
+                    logging.warning("No se pudo borrar %s en %s", r_dir, container)
     else:
         env = {**os.environ, "PGPASSWORD": password}
-        run(["pg_dump", "-U", user, "-h", host, "-p", port, "-d", db, "-F", "p", "-f", l_plain], env=env)
-        run(["pg_dump", "-U", user, "-h", host, "-p", port, "-d", db, "-F", "c", "-f", l_custom], env=env)
+        with tempfile.TemporaryDirectory(dir=backup_dir, prefix=f".{db}_{ts}.") as tmp:
+            l_dir = os.path.join(tmp, "dump")
+            run(["pg_dump", "-U", user, "-h", host, "-p", port, "-d", db, "-F", "d", "-j", str(jobs), "-Z", "0", "-f", l_dir], env=env)
+            with atomic_output(l_archive) as f:
+                run_pipeline([["tar", "-C", l_dir, "-cf", "-", "."], ZSTD_COMPRESS], stdout=f, hasher=hasher)
+                write_checksum(l_archive, algo, hasher.hexdigest())
 
-def backup_mysql_db(db: str, user: str, password: str, port: str, host: str, backup_dir: str, container: Optional[str]) -> None:
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    l_plain = os.path.join(backup_dir, f"{db}_{ts}.sql")
-    r_plain = f"/tmp/{db}_{ts}.sql"
+def backup_mysql_db(db: str, user: str, password: str, port: str, host: str, backup_dir: str, container: Optional[str], ts: str) -> None:
+    l_plain = os.path.join(backup_dir, f"{db}_{ts}.sql{ZSTD_EXT}")
+    # argv directo, sin sh -c: la redirección la hace Python con stdout=
     if container:
         # Versión simplificada para contenedores - sin host/port
-        mysqldump_cmd = f"mysqldump -u{shlex.quote(user)} -p'{password}' {shlex.quote(db)} > {shlex.quote(r_plain)}"
+        dump_cmd = docker_exec_cmd(container, ["mysqldump", f"-u{user}", db], MYSQL_PWD_PASSTHROUGH)
     else:
-        mysqldump_cmd = f"mysqldump -u{shlex.quote(user)} -p'{password}' -P{shlex.quote(port)}"
+        dump_cmd = ["mysqldump", f"-u{user}", f"-P{port}"]
         if host:
-            mysqldump_cmd += f" -h{shlex.quote(host)}"
-        mysqldump_cmd += f" {shlex.quote(db)} > {shlex.quote(r_plain)}"
-    
-    if container:
-        docker_exec(container, ["sh", "-c", mysqldump_cmd])
-        run(["docker", "cp", f"{container}:{r_plain}", l_plain])
-        docker_exec(container, ["rm", r_plain])
+            dump_cmd.append(f"-h{host}")
+        dump_cmd.append(db)
+    algo, hasher = new_hasher()
+    with atomic_output(l_plain) as f:
+        run_pipeline([dump_cmd, ZSTD_COMPRESS], env=mysql_env(password), stdout=f, hasher=hasher)
+        write_checksum(l_plain, algo, hasher.hexdigest())
+
+def _log_backup_failure(db_conf: Dict[str, Any], e: subprocess.CalledProcessError, db: Optional[str] = None) -> None:
+    safe_conf = sanitize_conf(db_conf)
+    stderr = getattr(e, 'stderr', b'')
+    if isinstance(stderr, bytes):
+        stderr = stderr.decode(errors='ignore')
+    if db:
+        logging.error("Backup failed for DB %s (%s): rc=%s cmd=%s stderr=%s", db, safe_conf, e.returncode, e.cmd, (stderr or '').strip())
     else:
-        with open(l_plain, 'w', encoding='utf-8') as f:
-            subprocess.run(["bash", "-c", mysqldump_cmd.replace(f"> {shlex.quote(r_plain)}", "")], check=True, stdout=f)
+        logging.error("Backup failed (%s): rc=%s cmd=%s stderr=%s", safe_conf, e.returncode, e.cmd, (stderr or '').strip())
+
+def _mark_done(key: str, date: str) -> None:
+    try:
+        mark_done(key, date)
+    except OSError as e:
+        logging.warning("No se pudo actualizar el estado de respaldos: %s", e)
 
-def backup_database(db_conf: Dict[str, Any]) -> None:
+def backup_database(db_conf: Dict[str, Any], already_done: Iterable[str] = ()) -> bool:
+    try:
+        return _backup_database(db_conf, already_done)
+    finally:
+        # los workers del daemon viven entre ciclos: no dejar sesiones docker exec abiertas
+        close_shells()
+
+def _backup_database(db_conf: Dict[str, Any], already_done: Iterable[str]) -> bool:
     db_type = db_conf.get('type', 'postgres').lower()
     user = db_conf['username']
     password = db_conf['password']
@@ -126,32 +266,67 @@ def backup_database(db_conf: Dict[str, Any]) -> None:
     host = db_conf.get('host', '127.0.0.1')
     backup_dir = db_conf.get('backup_dir', './')
     container = db_conf.get('container')
+    if shutil.which(ZSTD_COMPRESS[0]) is None:
+        logging.error("%s (%s)", ZSTD_MISSING, sanitize_conf(db_conf))
+        return False
     ensure_backup_dir(backup_dir)
 
     try:
         if db_type == 'postgres':
             dbs = [db_conf['db']] if db_conf.get('db') else list_postgres_databases(user, password, port, host, container=container)
-            for db in dbs:
-                logging.info("Backing up Postgres DB: %s", db)
-                backup_postgres_db(db, user, password, port, host, backup_dir, container)
+            jobs = int(db_conf.get('jobs', PG_DUMP_JOBS))
+            worker, label = functools.partial(backup_postgres_db, jobs=jobs), 'Postgres'
         elif db_type in ('mysql', 'mariadb'):
             dbs = [db_conf['db']] if db_conf.get('db') else list_mysql_databases(user, password, port, host, container=container)
-            for db in dbs:
-                logging.info("Backing up %s DB: %s", db_type, db)
-                backup_mysql_db(db, user, password, port, host, backup_dir, container)
+            worker, label = backup_mysql_db, db_type
         else:
             logging.error("Unsupported DB type: %s", db_type)
+            return False
     except subprocess.CalledProcessError as e:
-        safe_conf = {k: ('***' if k == 'password' else v) for k, v in db_conf.items()}
-        stderr = getattr(e, 'stderr', b'')
-        if isinstance(stderr, bytes):
-            stderr = stderr.decode(errors='ignore')
-        logging.error("Backup failed (%s): rc=%s cmd=%s stderr=%s", safe_conf, e.returncode, e.cmd, stderr.strip())
+        _log_backup_failure(db_conf, e)
+        return False
+    if not dbs:
+        return False
+
+    # un timestamp por ejecución: el nombre de la base ya distingue los archivos
+    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+    today = ts.split('_', 1)[0]
+    # el éxito se registra por base: al reintentar solo se respaldan las que aún no tienen copia de hoy
+    state = load_state()
+    skip = set(already_done)
+    pending = [db for db in dbs if db not in skip and state.get(state_key(db_conf, db)) != today]
+    if len(pending) < len(dbs):
+        logging.info("Ya existe respaldo de hoy para: %s", ', '.join(db for db in dbs if db not in pending))
+    dbs = pending
+
+    # Los dumps pasan casi todo el tiempo esperando a pg_dump/mysqldump: se lanzan en paralelo
+    max_workers = max(1, int(db_conf.get('parallelism', min(8, len(dbs) or 1))))
+    ok = True
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        futs = {}
+        for db in dbs:
+            logging.info("Backing up %s DB: %s", label, db)
+            futs[ex.submit(worker, db, user, password, port, host, backup_dir, container, ts)] = db
+        for fut in as_completed(futs):
+            try:
+                fut.result()
+            except subprocess.CalledProcessError as e:
+                _log_backup_failure(db_conf, e, futs[fut])
+                ok = False
+            except Exception:
+                # OSError (disco lleno, permisos), RuntimeError...: no debe cortar el resto de bases
+                logging.exception("Backup failed for DB %s (%s)", futs[fut], sanitize_conf(db_conf))
+                ok = False
+            else:
+                _mark_done(state_key(db_conf, futs[fut]), today)
+    if ok:
+        _mark_done(state_key(db_conf), today)
+    return ok
 
 def backup_all() -> None:
     for conf in DATABASES:
         backup_database(conf)
 
 __all__ = [
-    'DATABASES', 'backup_database', 'backup_all'
+    'DATABASES', 'SAFE_DATABASES', 'sanitize_conf', 'backup_database', 'backup_all'
 ]
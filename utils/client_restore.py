@@ -2,35 +2,91 @@ from __future__ import annotations
 
 import os
 import logging
-import shlex
+import shutil
 import subprocess
+import tempfile
 import argparse
 import sys
 from datetime import datetime
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Tuple
 
-from .client_backup import docker_exec, run, load_config
-from .logging_config import init_logging
+from .client_backup import (MYSQL_PWD_PASSTHROUGH, PARTIAL_EXT, PG_ARCHIVE_EXT, PG_DUMP_JOBS, ZSTD_EXT, ZSTD_MISSING, docker_exec_cmd, load_config,
+							mysql_env, run, run_pipeline, shell_exec)
+from .docker_shell import close_all as close_shells, docker_shell
+from .check import CHUNK_SIZE
+from .logging_config import LazyCmd, init_logging
 
 LOGGER = logging.getLogger(__name__)
 
-POSTGRES_EXT_PRIORIDAD = [".backup", ".sql"]  # prefer custom format
-MYSQL_EXT = [".sql"]
+POSTGRES_EXT_PRIORIDAD = [PG_ARCHIVE_EXT, ".backup.zst", ".backup", ".sql.zst", ".sql"]  # prefer directory, then custom format
+MYSQL_EXT = [".sql.zst", ".sql"]
+ZSTD_DECOMPRESS = ["zstd", "-d", "-q", "-c"]
+
+
+def _split_ext(file_path: str) -> Tuple[str, bool]:
+	"""Return (ext, compressed) where ext ignores a trailing .zst."""
+	compressed = file_path.endswith(ZSTD_EXT)
+	if compressed:
+		file_path = file_path[:-len(ZSTD_EXT)]
+	return os.path.splitext(file_path)[1], compressed
+
+
+def _feed_file(file_path: str, cmd: List[str], *, compressed: bool, env: Optional[Dict[str, str]] = None,
+			   prologue: bytes = b"") -> None:
+	# cmd lee el backup por stdin; los .zst pasan antes por zstd -dc.
+	# prologue se escribe antes del contenido del archivo, en la misma sesión
+	if not prologue:
+		if compressed:
+			run_pipeline([ZSTD_DECOMPRESS + [file_path], cmd], env=env)
+		else:
+			with open(file_path, 'rb') as f:
+				run(cmd, env=env, stdin=f)
+		return
+	LOGGER.debug("RUN: %s", LazyCmd(cmd))
+	with tempfile.TemporaryFile() as err:
+		proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=err, env=env)
+		feed_error: Optional[subprocess.CalledProcessError] = None
+		try:
+			proc.stdin.write(prologue)
+			proc.stdin.flush()  # zstd escribe directo al descriptor
+			if compressed:
+				run_pipeline([ZSTD_DECOMPRESS + [file_path]], stdout=proc.stdin)
+			else:
+				with open(file_path, 'rb') as f:
+					shutil.copyfileobj(f, proc.stdin, CHUNK_SIZE)
+		except BrokenPipeError:
+			pass  # cmd terminó antes (p.ej. ON_ERROR_STOP); su código de salida lo refleja
+		except subprocess.CalledProcessError as e:
+			# si cmd dejó de leer, zstd muere por SIGPIPE: el error que interesa es el de cmd
+			feed_error = e
+		finally:
+			try:
+				proc.stdin.close()
+			except BrokenPipeError:
+				pass
+			proc.wait()
+		if proc.returncode:
+			err.seek(0)
+			raise subprocess.CalledProcessError(proc.returncode, proc.args, stderr=err.read())
+		if feed_error is not None:
+			raise feed_error
+
+
+def _pg_ident(name: str) -> str:
+	return '"' + name.replace('"', '""') + '"'
 
 
 def _list_backup_files(backup_dir: str, db_name: str, exts: List[str]) -> List[str]:
 	if not os.path.isdir(backup_dir):
 		return []
 	prefix = f"{db_name}_"
-	files = []
-	for f in os.listdir(backup_dir):
-		if not f.startswith(prefix):
-			continue
-		if any(f.endswith(ext) for ext in exts):
-			files.append(os.path.join(backup_dir, f))
+	exts = tuple(exts)
+	# scandir trae el stat cacheado en cada DirEntry; los .partial son dumps aún en curso
+	with os.scandir(backup_dir) as it:
+		entries = [e for e in it if e.name.startswith(prefix) and e.name.endswith(exts) and PARTIAL_EXT not in e.name]
 	# sort by mtime desc
-	files.sort(key=lambda p: os.path.getmtime(p), reverse=True)
-	return files
+	entries.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+	return [e.path for e in entries]
 
 
 def _choose_latest(files: List[str], preferred_order: List[str]) -> Optional[str]:
@@ -44,76 +100,72 @@ def _choose_latest(files: List[str], preferred_order: List[str]) -> Optional[str
 	return files[0]
 
 
-def _restore_postgres(db_name: str, file_path: str, user: str, password: str, port: str, host: str, *, container: Optional[str]) -> None:
+def _restore_postgres_directory(file_path: str, user: str, password: str, port: str, host: str, *, container: Optional[str], jobs: int) -> None:
+	# inverso del backup: zstd -dc | tar -x en un directorio y pg_restore -Fd -j N
 	env_vars = {"PGPASSWORD": password}
-	ext = os.path.splitext(file_path)[1]
+	decompress = ZSTD_DECOMPRESS + [file_path]
 	if container:
-		remote = f"/tmp/restore_{os.path.basename(file_path)}"
-		# copiar al contenedor
-		run(["docker", "cp", file_path, f"{container}:{remote}"])
-		try:
-			if ext == ".backup":  # formato custom
-				# -C crea la DB, limpiamos antes por si existe
-				cmd = ["pg_restore", "-U", user, "-h", host, "-p", port, "-C", "-d", "postgres", remote]
-				docker_exec(container, cmd, env_vars=env_vars)
-			else:  # .sql
-				# Drop + create y luego cargar el script
-				stmt = f"DROP DATABASE IF EXISTS {shlex.quote(db_name)}; CREATE DATABASE {shlex.quote(db_name)};"
-				docker_exec(container, ["psql", "-U", user, "-h", host, "-p", port, "-d", "postgres", "-c", stmt], env_vars=env_vars)
-				docker_exec(container, ["psql", "-U", user, "-h", host, "-p", port, "-d", db_name, "-f", remote], env_vars=env_vars)
-		finally:
-			# limpiar
+		remote = f"/tmp/restore_{os.path.basename(file_path)[:-len(PG_ARCHIVE_EXT)]}.dir"
+		with docker_shell(container) as sh:
 			try:
-				docker_exec(container, ["rm", "-f", remote])
-			except Exception:  # noqa
-				pass
+				sh.run(["mkdir", "-p", remote])
+				run_pipeline([decompress, docker_exec_cmd(container, ["tar", "-C", remote, "-xf", "-"], interactive=True)])
+				cmd = ["pg_restore", "-U", user, "-h", host, "-p", port, "-F", "d", "-j", str(jobs), "-C", "-d", "postgres", remote]
+				sh.run(cmd, env_vars)
+			finally:
+				try:
+					sh.run(["rm", "-rf", remote])
+				except Exception:  # noqa
+					pass
 	else:
 		env = {**os.environ, **env_vars}
+		with tempfile.TemporaryDirectory(prefix="restore_") as tmp:
+			run_pipeline([decompress, ["tar", "-C", tmp, "-xf", "-"]])
+			run(["pg_restore", "-U", user, "-h", host, "-p", port, "-F", "d", "-j", str(jobs), "-C", "-d", "postgres", tmp], env=env)
+
+
+def _restore_postgres(db_name: str, file_path: str, user: str, password: str, port: str, host: str, *, container: Optional[str],
+					  jobs: int = PG_DUMP_JOBS) -> None:
+	env_vars = {"PGPASSWORD": password}
+	ext, compressed = _split_ext(file_path)
+	if compressed and ext == ".tar":
+		_restore_postgres_directory(file_path, user, password, port, host, container=container, jobs=jobs)
+	else:
+		# el archivo entra por stdin (zstd -dc si está comprimido): sin docker cp ni /tmp en el contenedor
 		if ext == ".backup":
-			# crear DB (pg_restore -C la crea; para eso apuntamos a postgres)
-			run(["pg_restore", "-U", user, "-h", host, "-p", port, "-C", "-d", "postgres", file_path], env=env)
-		else:
-			stmt = f"DROP DATABASE IF EXISTS {shlex.quote(db_name)}; CREATE DATABASE {shlex.quote(db_name)};"
-			run(["psql", "-U", user, "-h", host, "-p", port, "-d", "postgres", "-c", stmt], env=env)
-			run(["psql", "-U", user, "-h", host, "-p", port, "-d", db_name, "-f", file_path], env=env)
+			# -C crea la DB; para eso apuntamos a postgres
+			restore_cmd = ["pg_restore", "-U", user, "-h", host, "-p", port, "-C", "-d", "postgres"]
+			prologue = b""
+		else:  # .sql
+			# Drop + create, \c a la nueva base y el script, todo en una sola sesión de psql
+			ident = _pg_ident(db_name)
+			prologue = f"DROP DATABASE IF EXISTS {ident};\nCREATE DATABASE {ident};\n\\c {ident}\n".encode()
+			restore_cmd = ["psql", "-U", user, "-h", host, "-p", port, "-d", "postgres", "-v", "ON_ERROR_STOP=1"]
+		env = {**os.environ, **env_vars}
+		if container:
+			# "-e PGPASSWORD" sin valor: docker exec lo toma del entorno y la contraseña no queda en el argv
+			restore_cmd = docker_exec_cmd(container, restore_cmd, {"PGPASSWORD": None}, interactive=True)
+		_feed_file(file_path, restore_cmd, compressed=compressed, env=env, prologue=prologue)
 
 
 def _restore_mysql(db_name: str, file_path: str, user: str, password: str, port: str, host: str, *, container: Optional[str]) -> None:
-	# construimos comandos de drop/create + carga
+	# construimos comandos de drop/create + carga; la contraseña va en MYSQL_PWD
 	pre_sql = f"DROP DATABASE IF EXISTS `{db_name}`; CREATE DATABASE `{db_name}` CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;"
-	drop_create_cmd = ["mysql", f"-u{user}", f"-p{password}", f"-P{port}", "-e", pre_sql]
+	drop_create_cmd = ["mysql", f"-u{user}", f"-P{port}", "-e", pre_sql]
+	load_cmd = ["mysql", f"-u{user}", f"-P{port}", db_name]
 	if host:
-		drop_create_cmd.insert(3, f"-h{host}")
+		drop_create_cmd.insert(2, f"-h{host}")
+		load_cmd.insert(2, f"-h{host}")
+	env = mysql_env(password)
+	compressed = file_path.endswith(ZSTD_EXT)
 
 	if container:
-		docker_exec(container, drop_create_cmd)
-		# restore
-		# copiamos archivo al contenedor para evitar problemas de redirección con docker exec
-		remote = f"/tmp/restore_{os.path.basename(file_path)}"
-		run(["docker", "cp", file_path, f"{container}:{remote}"])
-		try:
-			restore_cmd = f"mysql -u{shlex.quote(user)} -p'{password}' -P{shlex.quote(port)}"
-			if host:
-				restore_cmd += f" -h{shlex.quote(host)}"
-			restore_cmd += f" {shlex.quote(db_name)} < {shlex.quote(remote)}"
-			docker_exec(container, ["sh", "-c", restore_cmd])
-		finally:
-			try:
-				docker_exec(container, ["rm", "-f", remote])
-			except Exception:  # noqa
-				pass
+		shell_exec(container, drop_create_cmd, {"MYSQL_PWD": password})
+		# el archivo entra por stdin de docker exec -i: sin docker cp ni /tmp en el contenedor
+		load_cmd = docker_exec_cmd(container, load_cmd, MYSQL_PWD_PASSTHROUGH, interactive=True)
 	else:
-		subprocess.run(drop_create_cmd, check=True)
-		restore_cmd = ["bash", "-c", _mysql_restore_shell(user, password, port, host, db_name, file_path)]
-		subprocess.run(restore_cmd, check=True)
-
-
-def _mysql_restore_shell(user: str, password: str, port: str, host: str, db: str, path: str) -> str:
-	parts = [f"mysql -u{shlex.quote(user)} -p'{password}' -P{shlex.quote(port)}"]
-	if host:
-		parts.append(f"-h{shlex.quote(host)}")
-	parts.append(shlex.quote(db))
-	return " ".join(parts) + f" < {shlex.quote(path)}"
+		run(drop_create_cmd, env=env)
+	_feed_file(file_path, load_cmd, compressed=compressed, env=env)
 
 
 def restore_database(db_conf: Dict[str, str], *, db: Optional[str] = None, file_path: Optional[str] = None) -> Optional[str]:
@@ -158,9 +210,13 @@ def restore_database(db_conf: Dict[str, str], *, db: Optional[str] = None, file_
 		if not file_path:
 			LOGGER.error("No se encontraron backups para %s en %s", target_db, backup_dir)
 			return None
+		if file_path.endswith(ZSTD_EXT) and shutil.which(ZSTD_DECOMPRESS[0]) is None:
+			LOGGER.error(ZSTD_MISSING)
+			return None
 		LOGGER.info("Restaurando %s desde %s", target_db, file_path)
 		if db_type == 'postgres':
-			_restore_postgres(target_db, file_path, user, password, port, host, container=container)
+			jobs = int(db_conf.get('jobs', PG_DUMP_JOBS))
+			_restore_postgres(target_db, file_path, user, password, port, host, container=container, jobs=jobs)
 		else:
 			_restore_mysql(target_db, file_path, user, password, port, host, container=container)
 		LOGGER.info("Restauración completada: %s", target_db)
@@ -173,6 +229,8 @@ def restore_database(db_conf: Dict[str, str], *, db: Optional[str] = None, file_
 		LOGGER.error("Fallo restauración (%s): rc=%s cmd=%s stderr=%s", safe_conf, e.returncode, e.cmd, stderr.strip())
 	except Exception:
 		LOGGER.exception("Error inesperado durante la restauración")
+	finally:
+		close_shells()
 	return None
 
 
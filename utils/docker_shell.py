@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import os
+import atexit
+import shlex
+import logging
+import tempfile
+import threading
+import contextlib
+import subprocess
+import uuid
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .logging_config import LazyCmd
+
+# Cada "docker exec" abre una conexión nueva con el daemon de Docker (~30-80 ms).
+# DockerShell mantiene un único "docker exec -i <c> sh" y le envía los comandos por
+# stdin, detectando el final de cada uno con un marcador seguido del código de salida.
+# Sirve para cualquier comando cuya salida sea texto, corto (mkdir, rm, listados) o largo
+# (pg_dump -Fd -j N, pg_restore -j N): la sesión queda ocupada hasta que termina y, como
+# docker_shell() entrega una sesión libre por hilo, los respaldos en paralelo no se bloquean.
+# Los flujos binarios (tar, zstd, dumps por stdin/stdout) siguen usando su propio docker exec.
+
+_READ_SIZE = 1 << 16
+_MAX_IDLE = 2  # sesiones libres que se conservan por contenedor; el resto se cierra al devolverlas
+
+
+class DockerShell:
+    def __init__(self, container: str):
+        self.container = container
+        self._marker = f"__END_{uuid.uuid4().hex}__".encode()
+        self._err = tempfile.TemporaryFile()
+        self._err_pos = 0
+        self._proc = subprocess.Popen(
+            ["docker", "exec", "-i", container, "sh"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self._err, bufsize=0,
+        )
+
+    @property
+    def alive(self) -> bool:
+        return self._proc.poll() is None
+
+    def run(self, cmd: List[str], env_vars: Optional[Dict[str, str]] = None, *, check: bool = True) -> subprocess.CompletedProcess:
+        # env_vars como asignaciones "K=v cmd": llegan por stdin, no quedan en ninguna línea de comandos
+        logging.debug("RUN [%s sh]: %s", self.container, LazyCmd(cmd))
+        assigns = ''.join(f"{k}={shlex.quote(v)} " for k, v in (env_vars or {}).items())
+        line = f"{assigns}{' '.join(shlex.quote(c) for c in cmd)} </dev/null\n"
+        line += f"printf '\\n%s%d\\n' {self._marker.decode()} $?\n"
+        try:
+            self._proc.stdin.write(line.encode())
+            out, rc = self._read_until_marker()
+        except (BrokenPipeError, EOFError):
+            stderr = self._new_stderr()
+            self.close()
+            raise subprocess.CalledProcessError(self._proc.returncode or -1, cmd, stderr=stderr)
+        stderr = self._new_stderr()
+        if check and rc:
+            raise subprocess.CalledProcessError(rc, cmd, output=out, stderr=stderr)
+        return subprocess.CompletedProcess(cmd, rc, stdout=out, stderr=stderr)
+
+    def _read_until_marker(self) -> Tuple[str, int]:
+        buf = b''
+        token = b'\n' + self._marker
+        while True:
+            chunk = os.read(self._proc.stdout.fileno(), _READ_SIZE)
+            if not chunk:
+                raise EOFError("docker exec sh terminó")
+            buf += chunk
+            idx = buf.find(token)
+            if idx != -1 and buf.endswith(b'\n'):
+                rc = int(buf[idx + len(token):].strip() or b'1')
+                return buf[:idx].decode(errors='replace'), rc
+
+    def _new_stderr(self) -> str:
+        # pread no mueve el offset compartido con sh, que sigue escribiendo al final
+        data = b''
+        while True:
+            chunk = os.pread(self._err.fileno(), _READ_SIZE, self._err_pos)
+            if not chunk:
+                break
+            data += chunk
+            self._err_pos += len(chunk)
+        return data.decode(errors='replace')
+
+    def close(self) -> None:
+        if self.alive:
+            try:
+                self._proc.stdin.close()
+                self._proc.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                self._proc.kill()
+                self._proc.wait()
+        self._err.close()
+
+
+# Shells libres por contenedor: cada hilo toma una (o crea otra) y la devuelve al terminar,
+# así los respaldos en paralelo no se serializan sobre la misma sesión.
+_idle: Dict[str, List[DockerShell]] = {}
+_idle_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def docker_shell(container: str) -> Iterator[DockerShell]:
+    shell = None
+    with _idle_lock:
+        shells = _idle.get(container)
+        while shells and shell is None:
+            candidate = shells.pop()
+            if candidate.alive:
+                shell = candidate
+            else:
+                candidate.close()
+    if shell is None:
+        shell = DockerShell(container)
+    try:
+        yield shell
+    except subprocess.CalledProcessError:
+        _release(shell)
+        raise
+    except BaseException:
+        shell.close()
+        raise
+    else:
+        _release(shell)
+
+
+def _release(shell: DockerShell) -> None:
+    if not shell.alive:
+        shell.close()
+        return
+    with _idle_lock:
+        shells = _idle.setdefault(shell.container, [])
+        if len(shells) < _MAX_IDLE:
+            shells.append(shell)
+            return
+    shell.close()
+
+
+def close_all() -> None:
+    with _idle_lock:
+        shells = [s for group in _idle.values() for s in group]
+        _idle.clear()
+    for shell in shells:
+        shell.close()
+
+
+def _forget_after_fork() -> None:
+    # las sesiones heredadas pertenecen al proceso padre
+    global _idle_lock
+    _idle.clear()
+    _idle_lock = threading.Lock()
+
+
+atexit.register(close_all)
+os.register_at_fork(after_in_child=_forget_after_fork)
+
+__all__ = ['DockerShell', 'docker_shell', 'close_all']
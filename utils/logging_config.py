@@ -1,18 +1,31 @@
 from __future__ import annotations
 
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
+import shlex
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
 
 DEFAULT_FORMAT = '%(asctime)s %(levelname)s %(name)s:%(lineno)d %(message)s'
 
+# Los workers solo encolan registros; la escritura a disco/consola la hace el hilo del listener
+_listener: Optional[logging.handlers.QueueListener] = None
+
+def _stop_listener() -> None:
+    if _listener is not None:
+        _listener.stop()
+
 def init_logging(level: int = logging.INFO, *, log_dir: str = 'logs', filename: Optional[str] = None,
                  fmt: str = DEFAULT_FORMAT) -> str:
+    global _listener
     root = logging.getLogger()
     if root.handlers:
         # Already configured; try to find FileHandler path
-        for h in root.handlers:
+        handlers = list(root.handlers) + list(_listener.handlers if _listener else ())
+        for h in handlers:
             if isinstance(h, logging.FileHandler):
                 return getattr(h, 'baseFilename', '')
         return ''
@@ -27,16 +40,30 @@ def init_logging(level: int = logging.INFO, *, log_dir: str = 'logs', filename:
 
     fh = logging.FileHandler(log_path, encoding='utf-8')
     fh.setFormatter(formatter)
-    root.addHandler(fh)
 
     ch = logging.StreamHandler()
     ch.setFormatter(formatter)
-    root.addHandler(ch)
+
+    q: queue.SimpleQueue = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(q))
+    _listener = logging.handlers.QueueListener(q, fh, ch, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_stop_listener)
 
     return log_path
 
+class LazyCmd:
+    # Formatea el comando (o tubería) solo si el registro se emite: "%s" llama a __str__ tarde
+    __slots__ = ('cmds',)
+
+    def __init__(self, *cmds: List[str]):
+        self.cmds = cmds
+
+    def __str__(self) -> str:
+        return ' | '.join(' '.join(shlex.quote(c) for c in cmd) for cmd in self.cmds)
+
 def get_logger(name: Optional[str] = None) -> logging.Logger:
     init_logging()  # idempotent
     return logging.getLogger(name)
 
-__all__ = ["init_logging", "get_logger"]
+__all__ = ["init_logging", "get_logger", "LazyCmd"]
@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import os
+import fcntl
+import json
+import logging
+import tempfile
+import threading
+from typing import Any, Dict, Optional
+
+STATE_FILE = os.path.join(os.path.dirname(__file__), '../backups/state.json')
+
+# threading.Lock dentro del proceso, flock entre los workers del pool del daemon
+_lock = threading.Lock()
+
+def state_key(db_conf: Dict[str, Any], db: Optional[str] = None) -> str:
+    # Identidad completa del respaldo: origen (container/host/port/usuario), tipo, destino y base.
+    # Dos servidores o dos destinos distintos nunca comparten entrada; sin 'db' se respaldan todas -> '*'.
+    # Con db se obtiene la entrada de una base concreta de una config múltiple
+    db_type = db_conf.get('type', 'postgres').lower()
+    port = db_conf.get('port', '5432' if db_type == 'postgres' else '3306')
+    parts = [
+        db_conf.get('container') or '',
+        db_type,
+        db_conf.get('host', '127.0.0.1'),
+        str(port),
+        db_conf.get('username', ''),
+        os.path.abspath(db_conf.get('backup_dir', './')),
+        db or db_conf.get('db') or '*',
+    ]
+    return '|'.join(parts)
+
+def load_state(path: str = STATE_FILE) -> Dict[str, str]:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, json.JSONDecodeError) as e:
+        logging.warning("State file ignored (%s): %s", path, e)
+        return {}
+    return data if isinstance(data, dict) else {}
+
+def _write_atomic(path: str, data: Dict[str, str]) -> None:
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.state.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+def mark_done(key: str, date: str, path: str = STATE_FILE) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with _lock, open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = load_state(path)
+        state[key] = date
+        _write_atomic(path, state)
+
+__all__ = ['STATE_FILE', 'state_key', 'load_state', 'mark_done']